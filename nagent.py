@@ -1,169 +1,420 @@
-import json
-from openai import AzureOpenAI
+import orjson
+from openai import AsyncAzureOpenAI
 import pymongo
+from pydantic import BaseModel
+from motor.motor_asyncio import AsyncIOMotorClient
 from duckduckgo_search import DDGS
 import asyncio
+import copy
+import functools
+import graphlib
+import hashlib
+import logging
+import sys
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import nullcontext
+from dataclasses import dataclass
 from datetime import datetime
 import re 
 from youtube_transcript_api import YouTubeTranscriptApi
 
 
+logger = logging.getLogger(__name__)
+
 # Define constants
 AZURE_OPENAI_ENDPOINT = "https://.openai.azure.com"
 AZURE_OPENAI_API_KEY = "" 
-az_client = AzureOpenAI(azure_endpoint=AZURE_OPENAI_ENDPOINT,api_version="2023-07-01-preview",api_key=AZURE_OPENAI_API_KEY)
+AZURE_OPENAI_API_VERSION = "2024-08-01-preview"
 MDB_URI = ""
 DB_NAME = ""
 COLLECTION_NAME = "agent_history"
+TOOL_DECISION_CACHE_SIZE = 2048
+STREAM_BATCH_CHUNKS = 32  # yield to the event loop after this many streamed chunks...
+STREAM_BATCH_SECONDS = 0.2  # ...or after this long, whichever comes first
+HISTORY_WINDOW = 3  # number of previous task results passed to the next task in a sequential process
+
+# Static prompts, kept at the head of each request so they form a cacheable prefix
+TOOL_SELECTION_PROMPT = """
+You are a helpful assistant that can help determine the best `tool` to use for a given `input` string.
+
+[available tools]
+{tool_info}
+
+[IMPORTANT! ONLY SELECT A TOOL FROM THE AVAILABLE TOOLS! IF NO TOOL IS AVAILABLE, DO NOT MAKE IT UP!]
+
+[response format]
+JSON response must have: 
+ `tool_id` key with the `id` of the tool.
+ `tool_input` key with the input that should be passed to the tool.
+ `original_input` key with the original input.
+"""
+BATCHED_TOOL_SELECTION_PROMPT = """
+You are a helpful assistant that can help determine the best `tool` to use for each of several `input` strings.
+
+[IMPORTANT! FOR EACH REQUEST ONLY SELECT A TOOL FROM ITS `available_tools`! IF NO TOOL IS AVAILABLE, DO NOT MAKE IT UP!]
+
+[response format]
+JSON response must have a `decisions` key with a list containing one object per request, each with:
+ `request_id` key with the `request_id` of the request.
+ `task_id` key with the `task_id` of the request.
+ `tool_id` key with the `id` of the tool, or null if no tool applies.
+ `tool_input` key with the input that should be passed to the tool.
+"""
+ANSWER_SYSTEM_PROMPT = """
+[IMPORTANT!]
+USE THE AVAILABLE CONTEXT WHEN APPLICABLE TO GENERATE YOUR RESPONSE!
+"""
+
+# LRU cache of LLM tool-selection decisions: key -> (tool_id, tool_input)
+_tool_decision_cache = OrderedDict()
+
+def tool_decision_key(*parts):
+    return hashlib.blake2b(repr(parts).encode(), digest_size=16).digest()
+
+def cache_tool_decision(key, decision):
+    _tool_decision_cache[key] = decision
+    if len(_tool_decision_cache) > TOOL_DECISION_CACHE_SIZE:
+        _tool_decision_cache.popitem(last=False)
+
+def memoize_pure(operation, maxsize=1024):
+    """
+    Memoize a pure tool operation; inputs that can't be hashed are passed straight to the tool.
+    """
+    cached = functools.lru_cache(maxsize=maxsize)(operation)
+    def memoized(input):
+        try:
+            hash(input)
+        except TypeError:
+            return operation(input)
+        return cached(input)
+    return memoized
+
+def encode_json(value):
+    """
+    Render task results (or structures holding them) as JSON text; anything orjson can't encode falls back to str().
+    """
+    try:
+        return orjson.dumps(value, default=str, option=orjson.OPT_NON_STR_KEYS).decode()
+    except orjson.JSONEncodeError:  # e.g. integers wider than 64 bits
+        return str(value)
+
+# One pooled (async) MongoDB client per URI, shared by every ConversationHistory
+_mongo_clients = {}
+
+def get_mongo_client(mongo_uri):
+    client = _mongo_clients.get(mongo_uri)
+    if client is None:
+        client = AsyncIOMotorClient(
+            mongo_uri,
+            maxPoolSize=50,
+            minPoolSize=5,
+            maxIdleTimeMS=300000,
+            compressors="zstd",
+            retryWrites=True,
+        )
+        _mongo_clients[mongo_uri] = client
+    return client
 
 class ConversationHistory:
-    def __init__(self, mongo_uri=None):
-        # If MongoDB URI is provided, connect to MongoDB
-        if mongo_uri:
-            self.client = pymongo.MongoClient(mongo_uri)
+    def __init__(self, mongo_uri=None, client=None):
+        self.client = client
+        # Pending history documents, written to MongoDB in a single bulk_write on the next flush
+        self._buffer = []
+        # If MongoDB URI is provided, connect to MongoDB (unless a client was injected)
+        if self.client is None and mongo_uri:
+            self.client = get_mongo_client(mongo_uri)
+        if self.client is not None:
             self.db = self.client[DB_NAME]
             self.collection = self.db[COLLECTION_NAME]
 
-    def add_to_history(self, history_object, is_user=True):
+    async def add_to_history(self, history_object, is_user=True):
         """
         Add a new entry to the conversation history.
         """
-        # If MongoDB client is available, insert the conversation into MongoDB
+        # If MongoDB client is available, queue the conversation for MongoDB
         if self.client:
-            self.collection.insert_one(history_object)
+            self._buffer.append(pymongo.InsertOne(history_object))
+
+    async def flush(self):
+        """
+        Write all pending history entries to MongoDB.
+        """
+        if self.client and self._buffer:
+            # Swap the buffer out before awaiting so concurrent adds are not lost or written twice
+            requests, self._buffer = self._buffer, []
+            try:
+                await self.collection.bulk_write(requests, ordered=False)
+            except pymongo.errors.BulkWriteError:
+                # The server rejected some documents (retrying won't change that) and wrote the rest
+                raise
+            except Exception:
+                # The write did not go through: put the requests back so the next flush retries them
+                self._buffer[:0] = requests
+                raise
+
+# History documents waiting to be written by the background writer: (ConversationHistory, document)
+_history_queue = None
+_history_writer_task = None
+
+def enqueue_history(memory, history_object):
+    """
+    Hand a history document to the background writer without waiting for MongoDB.
+    """
+    global _history_queue, _history_writer_task
+    if _history_writer_task is None or _history_writer_task.done():
+        _history_queue = asyncio.Queue()
+        _history_writer_task = asyncio.create_task(_history_writer())
+    _history_queue.put_nowait((memory, history_object))
+
+async def _history_writer():
+    while True:
+        batch = [await _history_queue.get()]
+        while not _history_queue.empty():
+            batch.append(_history_queue.get_nowait())
+        try:
+            memories = {}
+            for memory, history_object in batch:
+                await memory.add_to_history(history_object)
+                memories[id(memory)] = memory
+            for memory in memories.values():
+                await memory.flush()
+        except Exception as error:
+            logger.error("Error writing history: %s", error)
+        finally:
+            for _ in batch:
+                _history_queue.task_done()
+
+async def drain_history():
+    """
+    Wait until every queued history document has been written.
+    """
+    if _history_queue is not None:
+        await _history_queue.join()
  
+class ToolDecision(BaseModel):
+    tool_id: str | None
+    tool_input: str | None
+    original_input: str
+
+class BatchedToolDecision(BaseModel):
+    request_id: int
+    task_id: str
+    tool_id: str | None
+    tool_input: str | None
+
+class BatchedToolDecisions(BaseModel):
+    decisions: list[BatchedToolDecision]
+
+@dataclass
+class TaskFailure:
+    """
+    Result of a task that raised, so callers can tell failures apart from real results (including None).
+    """
+    error: Exception
+
+    def __repr__(self):
+        return f"TaskFailure({self.error!r})"
+
 class Tool:
-    def __init__(self, name, description, operation):
+    def __init__(self, name, description, operation, pure=False):
         self.name = name
         self.description = description
-        self.operation = operation
+        # Pure tools always return the same output for the same input, so memoize them
+        self.operation = memoize_pure(operation) if pure else operation
+        self.pure = pure
         self.usage_count = 0
 
     def run(self, input):
         return self.operation(input)
+
+    def __copy__(self):
+        # Copies share the (possibly memoized) operation but keep their own usage count
+        clone = Tool.__new__(Tool)
+        clone.__dict__.update(self.__dict__)
+        clone.usage_count = 0
+        return clone
 class Task:
-    def __init__(self, task_id, description, run_function, tools=None, critical=False):
+    def __init__(self, task_id, description, run_function, tools=None, critical=False, dependencies=None):
         self.task_id = task_id
         self.description = description
         self.run_function = run_function
         self.tools = tools if tools else []
+        self._tools_by_name = {tool.name: tool for tool in self.tools}
         self.tool_limits = {}
         self.critical = critical
+        self.dependencies = dependencies if dependencies else []  # task_ids whose results this task needs
+        self.tool_memo = None  # set by the CustomProcess to share tool results across its tasks
 
     async def use_tool(self, tool_name, input):
-        tool = next((tool for tool in self.tools if tool.name == tool_name), None)
-        if not tool:
+        tool = self._tools_by_name.get(tool_name)
+        if tool is None:
             raise Exception(f"No tool found with name: {tool_name}")
         if tool_name in self.tool_limits and self.tool_limits[tool_name] <= tool.usage_count:
             raise Exception(f"Usage limit exceeded for tool: {tool.name} in task: {self.description}")
         tool.usage_count += 1
-        return tool.run(input)
+        if self.tool_memo is None or not tool.pure:
+            return tool.run(input)
+        # Keyed on the operation, which copies of a tool share, so tools that only share a name don't collide
+        memo_key = (tool.operation, repr(input))
+        if memo_key not in self.tool_memo:
+            self.tool_memo[memo_key] = tool.run(input)
+        return self.tool_memo[memo_key]
 
     async def execute(self, input=None):
+        t0 = time.perf_counter()
         result = await self.run_function(input)
         for tool in self.tools:
             result = await self.use_tool(tool.name, result)
-        print(f"{datetime.now()} - Finished task: {self.description}")
+        logger.info("Finished task: %s in %.3fs", self.description, time.perf_counter() - t0)
         return result
 
     def set_tool_limit(self, tool_name, limit):
         self.tool_limits[tool_name] = limit
+
+    def __copy__(self):
+        # Each copy gets its own tools so usage counts and limits are tracked per copy
+        clone = self.__class__.__new__(self.__class__)
+        clone.__dict__.update(self.__dict__)
+        clone.tools = [copy.copy(tool) for tool in self.tools]
+        clone._tools_by_name = {tool.name: tool for tool in clone.tools}
+        clone.tool_limits = dict(self.tool_limits)
+        return clone
 class LLMTask(Task):
-    def __init__(self, task_id, description, run_function, tools=None, critical=False, llm=None, llm_model=None):
-        self.task_id = task_id
-        self.description = description
-        self.run_function = run_function
-        self.tools = tools if tools else []
-        self.tool_limits = {}
-        self.tool_info = {tool.name: tool.description for tool in tools}  # Generate dictionary of tool names and descriptions
-        self.critical = critical
+    def __init__(self, task_id, description, run_function, tools=None, critical=False, llm=None, llm_model=None, dependencies=None):
+        super().__init__(task_id, description, run_function, tools, critical=critical, dependencies=dependencies)
+        self.tool_info = {tool.name: tool.description for tool in self.tools}  # Generate dictionary of tool names and descriptions
+        # Stable (sorted) rendering of the tool catalog so the prompt prefix is identical across calls
+        self.tool_info_str = orjson.dumps(self.tool_info, option=orjson.OPT_SORT_KEYS).decode()
+        self.system_prompt = TOOL_SELECTION_PROMPT.format(tool_info=self.tool_info_str)
         self.llm = llm
         self.llm_model = llm_model
+        self.router = None  # set by the Agent to a BatchedRouter shared by tasks that run concurrently
+        self.llm_semaphore = None  # set by the Agent to bound concurrent LLM calls
+        self.session_id = None  # set by the Agent, lets the provider route calls to a warm prompt cache
 
-    async def use_tool(self, tool_name, input):
-        tool = next((tool for tool in self.tools if tool.name == tool_name), None)
-        if not tool:
-            raise Exception(f"No tool found with name: {tool_name}")
-        if tool_name in self.tool_limits and self.tool_limits[tool_name] <= tool.usage_count:
-            raise Exception(f"Usage limit exceeded for tool: {tool.name} in task: {self.description}")
-        tool.usage_count += 1
-        return tool.run(input)
+    async def create_completion(self, **kwargs):
+        if self.session_id:
+            kwargs["user"] = self.session_id
+        async with self.llm_semaphore or nullcontext():
+            return await self.llm.chat.completions.create(**kwargs)
 
-    async def execute(self, input=None):
-        print(f"{datetime.now()} - Starting task: {self.description}")
-        if self.llm:
-            ai_msg = self.llm.chat.completions.create(
-                model=self.llm_model,
-                messages=[
-                    {"role": "system", "content": """
-You are a helpful assistant that can help determine the best `tool` to use for a given `input` string.
-"""},
-                    {"role": "user", "content": f"""
-What is the best tool to use given this input
-
-Input: `{self.description}`
-
-[available tools]
-{self.tool_info}
+    async def parse_completion(self, **kwargs):
+        """
+        Run a Structured Outputs completion, whose message is parsed into `response_format`.
+        """
+        if self.session_id:
+            kwargs["user"] = self.session_id
+        async with self.llm_semaphore or nullcontext():
+            return await self.llm.beta.chat.completions.parse(**kwargs)
 
-[IMPORTANT! ONLY SELECT A TOOL FROM THE AVAILABLE TOOLS! IF NO TOOL IS AVAILABLE, DO NOT MAKE IT UP!]
+    async def stream_completion(self, **kwargs):
+        """
+        Stream a completion and return its text, yielding to other tasks between batches of chunks.
+        """
+        if self.session_id:
+            kwargs["user"] = self.session_id
+        loop = asyncio.get_running_loop()
+        parts = []
+        async with self.llm_semaphore or nullcontext():
+            stream = await self.llm.chat.completions.create(stream=True, **kwargs)
+            chunks_since_yield = 0
+            last_yield = loop.time()
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    parts.append(chunk.choices[0].delta.content)
+                chunks_since_yield += 1
+                if chunks_since_yield >= STREAM_BATCH_CHUNKS or loop.time() - last_yield >= STREAM_BATCH_SECONDS:
+                    await asyncio.sleep(0)
+                    chunks_since_yield = 0
+                    last_yield = loop.time()
+        return "".join(parts)
 
-[response format]
-JSON response must have: 
- `tool_id` key with the `id` of the tool.
- `tool_input` key with the input that should be passed to the tool.
- `original_input` key with the original input: `{input}` 
-"""}
-                ], 
-                response_format={ "type": "json_object" }
-            )
-            result = json.loads(ai_msg.choices[0].message.content)
-            tool_input = result.get("tool_input")
-            tool_id = result.get("tool_id")
-            if result:
-                if self.run_function:
-                    result = await self.run_function(input)
-                if tool_id:
-                    for tool in self.tools:
-                        if tool.name in tool_id:
-                            result = await self.use_tool(tool.name, tool_input)
-                            break
+    async def execute(self, input=None):
+        logger.info("Starting task: %s", self.description)
+        t0 = time.perf_counter()
+        if self.llm:
+            key = tool_decision_key(self.description, self.llm_model, self.tool_info_str, input)
+            decision = _tool_decision_cache.get(key)
+            if decision is None:
+                if self.router:
+                    decision = await self.router.decide(self.task_id, self.description, input, self.tool_info)
+                else:
+                    decision = await self.select_tool(input)
+                if decision is not None and decision[0] and decision[0] not in self._tools_by_name:
+                    logger.warning("Unknown tool: %s chosen for task: %s, answering without a tool", decision[0], self.description)
+                    decision = None
+                if decision is None:
+                    # The model refused, skipped this request or made up a tool: go without a tool, but ask again next time
+                    decision = (None, None)
                 else:
-                    # if no tool usage, lets respond with what we have
-                    result = self.llm.chat.completions.create(
-                        model=self.llm_model,
-                        messages=[
-                            {"role": "system", "content": f"""
+                    cache_tool_decision(key, decision)
+            else:
+                _tool_decision_cache.move_to_end(key)
+            tool_id, tool_input = decision
+            result = None
+            if self.run_function:
+                result = await self.run_function(input)
+            if tool_id:
+                result = await self.use_tool(tool_id, tool_input)
+            else:
+                # if no tool usage, lets respond with what we have
+                result = await self.stream_completion(
+                    model=self.llm_model,
+                    messages=[
+                        {"role": "system", "content": ANSWER_SYSTEM_PROMPT},
+                        {"role": "user", "content": f"""
 [task context]:
 {input}
 [end task context]
 
 [task description]:
 {self.description}
-
-[IMPORTANT!]
-USE THE AVAILABLE CONTEXT WHEN APPLICABLE TO GENERATE YOUR RESPONSE!
 """}
-                        ]
-                    )
-                    result = result.choices[0].message.content
+                    ]
+                )
         else:
             result = await self.run_function(input)
             for tool in self.tools:
                 result = await self.use_tool(tool.name, result)
-            print(f"{datetime.now()} - Finished task: {self.description}")
+        logger.info("Finished task: %s in %.3fs", self.description, time.perf_counter() - t0)
         return result
 
-    def set_tool_limit(self, tool_name, limit):
-        self.tool_limits[tool_name] = limit
+    async def select_tool(self, input):
+        """
+        Ask the LLM which tool to use, returning a (tool_id, tool_input) pair, or None if the model refused.
+        """
+        ai_msg = await self.parse_completion(
+            model=self.llm_model,
+            messages=[
+                {"role": "system", "content": self.system_prompt},
+                {"role": "user", "content": f"""
+What is the best tool to use given this input
+
+Input: `{self.description}`
+
+Original input: `{input}`
+"""}
+            ], 
+            response_format=ToolDecision
+        )
+        decision = ai_msg.choices[0].message.parsed
+        if decision is None:  # the model refused
+            return None
+        return decision.tool_id, decision.tool_input
 
 class CustomProcess:
-    def __init__(self, name, tasks=None, is_parallel=False):
+    def __init__(self, name, tasks=None, is_parallel=False, is_pipelined=False):
         self.name = name
         self.tasks = tasks if tasks else []
         self.is_parallel = is_parallel
+        # Pipelined processes start every task as soon as the tasks it depends on have finished
+        self.is_pipelined = is_pipelined
         self.execution_history = []
         self.failures = []
+        # Pure tool results memoized for the lifetime of this process: (tool operation, repr(input)) -> result
+        self._tool_memo = {}
     def process_to_json(self):
         """
         Convert a CustomProcess object to a JSON object.
@@ -171,6 +422,7 @@ class CustomProcess:
         process_dict = {
             "name": self.name,
             "is_parallel": self.is_parallel,
+            "is_pipelined": self.is_pipelined,
             "tasks": []
         }
         
@@ -178,6 +430,7 @@ class CustomProcess:
             task_dict = {
                 "task_id": task.task_id,
                 "description": task.description,
+                "dependencies": task.dependencies,
                 "tools": []
             }
             
@@ -190,83 +443,253 @@ class CustomProcess:
             
             process_dict["tasks"].append(task_dict)
         process_dict["timestamp"] = datetime.now()
-        process_dict["execution_history"] = self.get_execution_history()
+        # Results can be arbitrary objects, which BSON may not encode, so store them as JSON text
+        process_dict["execution_history"] = [
+            {**entry, "result": encode_json(entry["result"])}
+            for entry in self.execution_history
+        ]
         process_dict["failures"] = self.get_failures()
 
         return process_dict
     async def run(self):
         results = []
-        print(f"{datetime.now()} - Running tasks {'in parallel' if self.is_parallel else 'sequentially'} in process: {self.name}...")
+        for task in self.tasks:
+            task.tool_memo = self._tool_memo
+        if self.is_pipelined:
+            logger.info("Running tasks as a pipeline in process: %s...", self.name)
+            return await self.run_pipelined()
+        logger.info("Running tasks %s in process: %s...", "in parallel" if self.is_parallel else "sequentially", self.name)
         if self.is_parallel:
-            tasks = [self.execute_task(task) for task in self.tasks]
-            results = await asyncio.gather(*tasks, return_exceptions=True)
+            # execute_task never raises, so the group never cancels siblings; its tasks are created through
+            # the loop, so an eager task factory can finish quick tasks without scheduling them
+            async with asyncio.TaskGroup() as group:
+                tasks = [group.create_task(self.execute_task(task)) for task in self.tasks]
+            results = [task.result() for task in tasks]
         else:
             for task in self.tasks:
-                result = await self.execute_task(task, input="Execution history:"+" ".join(self.get_execution_history()))
-                if result is None and task.critical:
+                # Only the tail of the history is passed on, and without each entry's own task_input,
+                # so the input no longer grows with every task in the process
+                recent_history = [
+                    {"task_id": entry["task_id"], "description": entry["description"], "result": entry["result"]}
+                    for entry in self.execution_history[-HISTORY_WINDOW:]
+                ]
+                result = await self.execute_task(task, input="Execution history:"+encode_json(recent_history))
+                if task.critical and isinstance(result, TaskFailure):
                     break
                 results.append(result)
         return results
 
+    async def run_pipelined(self):
+        """
+        Start each task as soon as its dependencies have resolved, only waiting where a result is needed.
+        """
+        indexes_by_id = {}
+        for index, task in enumerate(self.tasks):
+            indexes_by_id.setdefault(task.task_id, []).append(index)
+        sorter = graphlib.TopologicalSorter()
+        for task in self.tasks:
+            for dependency in task.dependencies:
+                if dependency not in indexes_by_id:
+                    raise Exception(f"Unknown dependency: {dependency} for task: {task.description}")
+            sorter.add(task.task_id, *task.dependencies)
+        # Schedule in dependency order so every task can look up the futures of the tasks it needs;
+        # repetitions share a task_id, so each id maps to the (task, future) of every one of them
+        in_flight = {}
+        futures = [None] * len(self.tasks)
+        for task_id in sorter.static_order():
+            for index in indexes_by_id[task_id]:
+                futures[index] = asyncio.create_task(self.execute_after_dependencies(self.tasks[index], in_flight))
+                in_flight.setdefault(task_id, []).append((self.tasks[index], futures[index]))
+        results = []
+        for task, future in zip(self.tasks, futures):
+            result = await future
+            if task.critical and isinstance(result, TaskFailure):
+                # Cancel whatever is still running and record it, so callers can tell a cut-short run from a complete one
+                cancelled = [(other, pending) for other, pending in zip(self.tasks, futures) if not pending.done()]
+                for _, pending in cancelled:
+                    pending.cancel()
+                if cancelled:
+                    await asyncio.wait([pending for _, pending in cancelled])
+                for other, _ in cancelled:
+                    self.failures.append(f"Failure in process {self.name}: Task cancelled: {other.description}")
+                break
+            results.append(result)
+        return results
+
+    async def execute_after_dependencies(self, task, in_flight):
+        dependency_results = []
+        for dependency in task.dependencies:
+            for dependency_task, future in in_flight[dependency]:
+                result = await future
+                if dependency_task.critical and isinstance(result, TaskFailure):
+                    # A critical dependency failed, so there is nothing to build on
+                    return result
+                dependency_results.append({"task_id": dependency, "result": result})
+        return await self.execute_task(task, input="Execution history:"+encode_json(dependency_results))
+
     async def execute_task(self, task, input=None):
         try:
             result = await task.execute(input)
-            self.execution_history.append(str({
+            self.execution_history.append({
                 "task_id": task.task_id,
                 "description": task.description,
                 "result": result,
                 "task_input": input
-            }))
+            })
             return result
         except Exception as error:
-            print(f"{datetime.now()} - Error executing task: {task.description} in process: {self.name}", error)
+            logger.error("Error executing task: %s in process: %s %s", task.description, self.name, error)
             self.failures.append(f"Failure in process {self.name}: {str(error)}")
             if task.critical:
-                print(f"{datetime.now()} - Critical task failed. Exiting process: {self.name}")
-                return None
-            return error
+                logger.error("Critical task failed. Exiting process: %s", self.name)
+            return TaskFailure(error)
 
     def add_task(self, task, repetitions=1):
-        self.tasks.extend([task]*repetitions)
+        self.tasks.extend(copy.copy(task) for _ in range(repetitions))
 
     def clear_tasks(self):
         self.tasks.clear()
         self.execution_history.clear()
         self.failures.clear()
+        self._tool_memo.clear()
 
     def get_execution_history(self):
-        return self.execution_history.copy()
+        return iter(self.execution_history)
 
     def get_failures(self):
         return self.failures.copy()
 
+class BatchedRouter:
+    """
+    Coalesces tool-selection requests from concurrently running LLMTasks into a single LLM call.
+    """
+    def __init__(self, llm, llm_model, latency_budget_ms=30, max_batch=16):
+        self.llm = llm
+        self.llm_model = llm_model
+        self.latency_budget = latency_budget_ms / 1000
+        self.max_batch = max_batch
+        self._queue = None
+        self._worker = None
+        self.llm_semaphore = None  # set by the Agent to bound concurrent LLM calls
+        self.session_id = None  # set by the Agent, lets the provider route calls to a warm prompt cache
+
+    async def decide(self, task_id, description, input, tool_info):
+        """
+        Queue a tool-selection request and wait for its (tool_id, tool_input) decision (None if the model gave none).
+        """
+        if self._worker is None or self._worker.done():
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.create_task(self._run())
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((task_id, description, input, tool_info, future))
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.latency_budget
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            try:
+                decisions = await self._decide_batch(batch)
+            except Exception as error:
+                for *_, future in batch:
+                    if not future.done():
+                        future.set_exception(error)
+                continue
+            for index, (*_, future) in enumerate(batch):
+                if not future.done():
+                    future.set_result(decisions.get(index))
+
+    async def _decide_batch(self, batch):
+        requests = [
+            {"request_id": index, "task_id": task_id, "input": description, "original_input": str(input), "available_tools": tool_info}
+            for index, (task_id, description, input, tool_info, _) in enumerate(batch)
+        ]
+        kwargs = {"user": self.session_id} if self.session_id else {}
+        async with self.llm_semaphore or nullcontext():
+            ai_msg = await self.llm.beta.chat.completions.parse(
+                model=self.llm_model,
+                messages=[
+                    {"role": "system", "content": BATCHED_TOOL_SELECTION_PROMPT},
+                    {"role": "user", "content": orjson.dumps(requests).decode()}
+                ],
+                response_format=BatchedToolDecisions,
+                **kwargs
+            )
+        result = ai_msg.choices[0].message.parsed
+        if result is None:  # the model refused
+            return {}
+        return {
+            decision.request_id: (decision.tool_id, decision.tool_input)
+            for decision in result.decisions
+        }
+
 class Agent:
-    def __init__(self):
-        self.memory = ConversationHistory(mongo_uri=MDB_URI)
+    def __init__(self, memory=None, max_llm_concurrency=8, router=None):
+        self.memory = memory if memory else ConversationHistory(mongo_uri=MDB_URI)
+        self.llm_semaphore = asyncio.Semaphore(max_llm_concurrency)
+        self.session_id = uuid.uuid4().hex
+        self.router = router  # optional BatchedRouter for tool selection in parallel and pipelined processes
+        if self.router is not None:
+            self.router.llm_semaphore = self.llm_semaphore
+            self.router.session_id = self.session_id
     async def execute_process(self, process):
+        # A sequential process never has a second request to batch, so the router would only add its latency budget
+        router = self.router if process.is_parallel or process.is_pipelined else None
+        for task in process.tasks:
+            # Only LLMTasks talk to the LLM
+            if isinstance(task, LLMTask):
+                task.llm_semaphore = self.llm_semaphore
+                task.session_id = self.session_id
+                task.router = router
         results = await process.run()
-        self.memory.add_to_history(process.process_to_json())
+        enqueue_history(self.memory, process.process_to_json())
         return results
 
 async def main():
-    tool1 = Tool("UPPER", "Converts text to uppercase", lambda text: text.upper())
-    tool2 = Tool("DOUBLE", "Doubles the string", lambda text: text*2)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(message)s", stream=sys.stdout)
+    if hasattr(asyncio, "eager_task_factory"):  # Python 3.12+
+        asyncio.get_running_loop().set_task_factory(asyncio.eager_task_factory)
+    tool1 = Tool("UPPER", "Converts text to uppercase", lambda text: text.upper(), pure=True)
+    tool2 = Tool("DOUBLE", "Doubles the string", lambda text: text*2, pure=True)
+
+    # Build the clients once so their connection pools stay warm across every process below
+    az_client = AsyncAzureOpenAI(azure_endpoint=AZURE_OPENAI_ENDPOINT,api_version=AZURE_OPENAI_API_VERSION,api_key=AZURE_OPENAI_API_KEY)
+    memory = ConversationHistory(mongo_uri=MDB_URI)
+    router = BatchedRouter(az_client, 'gpt-4o')
 
     taskX = LLMTask("id_X", "convert `x` to uppercase", None, [tool1,tool2], critical=True, llm=az_client, llm_model='gpt-4o')
     taskY = LLMTask("id_Y", "double the string 'boom'", None, [tool1,tool2], critical=True, llm=az_client, llm_model='gpt-4o')
-    taskZ = LLMTask("id_Z", "combine the last two results", None, [], critical=True, llm=az_client, llm_model='gpt-4o')
+    taskZ = LLMTask("id_Z", "combine the last two results", None, [], critical=True, llm=az_client, llm_model='gpt-4o', dependencies=["id_X", "id_Y"])
 
     my_process1 = CustomProcess("Parallel Process", [taskX,taskY,taskZ], is_parallel=True)
-    agent1 = Agent()
+    agent1 = Agent(memory=memory, router=router)
     results = await agent1.execute_process(my_process1)
-    print("Results:", [result for result in results if not isinstance(result, Exception)])
+    print("Results:", [result for result in results if not isinstance(result, TaskFailure)])
     print("Tool Usage:", tool1.name, tool1.usage_count, tool2.name, tool2.usage_count)
     tool1.usage_count = 0 #reset usage count
     tool2.usage_count = 0 #reset usage count
     my_process2 = CustomProcess("Sequential Process", [taskX,taskY,taskZ], is_parallel=False)
-    agent1 = Agent()
     results = await agent1.execute_process(my_process2)
-    print("Results:", [result for result in results if not isinstance(result, Exception)])
+    print("Results:", [result for result in results if not isinstance(result, TaskFailure)])
+    print("Tool Usage:", tool1.name, tool1.usage_count, tool2.name, tool2.usage_count)
+    tool1.usage_count = 0 #reset usage count
+    tool2.usage_count = 0 #reset usage count
+    # taskZ starts as soon as taskX and taskY have finished, and gets both of their results
+    my_process3 = CustomProcess("Pipelined Process", [taskX,taskY,taskZ], is_pipelined=True)
+    results = await agent1.execute_process(my_process3)
+    print("Results:", [result for result in results if not isinstance(result, TaskFailure)])
     print("Tool Usage:", tool1.name, tool1.usage_count, tool2.name, tool2.usage_count)
+    await drain_history()
 
-asyncio.run(main())
+if __name__ == "__main__":
+    with asyncio.Runner() as runner:
+        runner.run(main())
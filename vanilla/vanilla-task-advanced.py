@@ -1,95 +1,308 @@
 import asyncio
-from datetime import datetime
+import functools
+import inspect
+import itertools
+import logging
+import logging.handlers
+import sys
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+_MISSING = object()
+
+class BufferedLogHandler(logging.handlers.BufferingHandler):
+    """Hold log records and write them to the stream in a single call when flushed (or when the buffer fills)."""
+
+    def __init__(self, stream, capacity=1000):
+        super().__init__(capacity)
+        self.stream = stream
+
+    def flush(self):
+        with self.lock:
+            if self.buffer:
+                self.stream.write("".join(self.format(record) + "\n" for record in self.buffer))
+                self.stream.flush()
+                self.buffer.clear()
+
+class ToolNotFound(Exception):
+    __slots__ = ()
+
+class ToolLimitExceeded(Exception):
+    __slots__ = ()
+
+# Failures a task is expected to hit; only their message is kept, so their tracebacks are dropped
+_EXPECTED_FAILURES = (ToolNotFound, ToolLimitExceeded)
+
+def _memoize(operation, maxsize=128):
+    """Memoize a pure tool operation; inputs that can't be hashed are passed straight to the tool."""
+    if inspect.iscoroutinefunction(operation):
+        # lru_cache would cache the coroutine object, which can only be awaited once, so cache awaited results
+        results = OrderedDict()
+
+        async def memoized(input):
+            try:
+                hash(input)
+            except TypeError:
+                return await operation(input)
+            if input in results:
+                results.move_to_end(input)
+                return results[input]
+            result = results[input] = await operation(input)
+            if len(results) > maxsize:
+                results.popitem(last=False)
+            return result
+    else:
+        cached = functools.lru_cache(maxsize=maxsize)(operation)
+
+        def memoized(input):
+            try:
+                hash(input)
+            except TypeError:
+                return operation(input)
+            return cached(input)
+    return memoized
 
 class Tool:
-    def __init__(self, name, description, operation):
+    __slots__ = ("name", "description", "operation", "pure", "usage_count", "_is_coro")
+
+    def __init__(self, name, description, operation, pure=False):
         self.name = name
         self.description = description
-        self.operation = operation
+        # Pure tools always return the same output for the same input, so memoize them
+        self.operation = _memoize(operation) if pure else operation
+        self.pure = pure
         self.usage_count = 0
+        self._is_coro = inspect.iscoroutinefunction(operation)
 
     def run(self, input):
         return self.operation(input)
 
+def _chain(pipeline, tool):
+    """Extend a composed tool pipeline with one more tool (pipeline may be None for the first tool)."""
+    operation = tool.operation
+    def step(value):
+        if pipeline is not None:
+            value = pipeline(value)
+        tool.usage_count += 1
+        return operation(value)
+    return step
+
 class Task:
-    def __init__(self, task_id, description, run_function, tools=None, critical=False):
+    __slots__ = ("task_id", "description", "run_function", "tools", "_tools_by_name", "tool_limits", "critical",
+                 "deterministic", "_cached_input", "_cached_result", "_run_is_coro", "_pipeline")
+
+    def __init__(self, task_id, description, run_function, tools=None, critical=False, deterministic=False):
         self.task_id = task_id
         self.description = description
         self.run_function = run_function
-        self.tools = tools if tools else []
+        self._run_is_coro = inspect.iscoroutinefunction(run_function)
+        # A tuple of our own: add_tool is the only way to change it, so the index and pipeline stay in step
+        self.tools = tuple(tools) if tools else ()
+        self._tools_by_name = {tool.name: tool for tool in self.tools}
         self.tool_limits = {}
         self.critical = critical
+        # Deterministic tasks remember the result of their last run_function call (single-slot cache)
+        self.deterministic = deterministic
+        self._cached_input = _MISSING
+        self._cached_result = _MISSING
+        self._specialize()
 
-    async def use_tool(self, tool_name, input):
-        tool = next((tool for tool in self.tools if tool.name == tool_name), None)
-        if not tool:
-            raise Exception(f"No tool found with name: {tool_name}")
-        if tool_name in self.tool_limits and self.tool_limits[tool_name] <= tool.usage_count:
-            raise Exception(f"Usage limit exceeded for tool: {tool.name} in task: {self.description}")
+    def _specialize(self):
+        """Pick the tool pipeline for the task's current shape; re-run whenever its tools or limits change."""
+        if self.tools and not self.tool_limits and not any(tool._is_coro for tool in self.tools):
+            # Only synchronous tools and nothing to check: compose the operations into a single call
+            self._pipeline = functools.reduce(_chain, self.tools, None)
+        else:
+            self._pipeline = None
+
+    def add_tool(self, tool):
+        self.tools += (tool,)
+        self._tools_by_name[tool.name] = tool
+        self._specialize()
+
+    def use_tool(self, tool_name, input):
+        """Run a tool on input; returns an awaitable if the tool's operation is a coroutine function."""
+        tool = self._tools_by_name.get(tool_name)
+        if tool is None:
+            raise ToolNotFound(f"No tool found with name: {tool_name}")
+        limit = self.tool_limits.get(tool_name)
+        if limit is not None and limit <= tool.usage_count:
+            raise ToolLimitExceeded(f"Usage limit exceeded for tool: {tool.name} in task: {self.description}")
         tool.usage_count += 1
         return tool.run(input)
 
     async def execute(self, input=None):
-        print(f"{datetime.now()} - Starting task: {self.description}")
-        result = await self.run_function(input)
-        for tool in self.tools:
-            result = await self.use_tool(tool.name, result)
-        print(f"{datetime.now()} - Finished task: {self.description}")
+        logger.info("Starting task: %s", self.description)
+        t0 = time.monotonic()
+        result = await self.call_run_function(input)
+        if self._pipeline is not None:
+            result = self._pipeline(result)
+        elif self.tools:  # tasks without tools skip the tool pipeline entirely
+            for tool in self.tools:
+                result = self.use_tool(tool.name, result)
+                if tool._is_coro:
+                    result = await result
+        logger.info("Finished task: %s in %.3fs", self.description, time.monotonic() - t0)
+        return result
+
+    async def call_run_function(self, input):
+        if self.deterministic and self._cached_result is not _MISSING and self._cached_input == input:
+            return self._cached_result
+        if self._run_is_coro:
+            result = await self.run_function(input)
+        else:
+            # Plain functions may still return an awaitable (e.g. a lambda returning asyncio.sleep(...))
+            result = self.run_function(input)
+            if inspect.isawaitable(result):
+                result = await result
+        if self.deterministic:
+            self._cached_input = input
+            self._cached_result = result
         return result
 
     def set_tool_limit(self, tool_name, limit):
         self.tool_limits[tool_name] = limit
+        self._specialize()
 
 class CustomProcess:
+    __slots__ = ("name", "tasks", "repetitions", "parallel_repeats", "is_parallel", "execution_history", "failures")
+
     def __init__(self, name, tasks=None, is_parallel=False):
         self.name = name
-        self.tasks = tasks if tasks else []
+        # Parallel lists: tasks[i] runs repetitions[i] times, concurrently if parallel_repeats[i]
+        self.tasks = list(tasks) if tasks else []
+        self.repetitions = [1] * len(self.tasks)
+        self.parallel_repeats = [False] * len(self.tasks)
         self.is_parallel = is_parallel
         self.execution_history = []
         self.failures = []
 
-    async def run(self):
+    async def run(self, timeout=None):
         results = []
-        print(f"{datetime.now()} - Running tasks {'in parallel' if self.is_parallel else 'sequentially'} in process: {self.name}...")
+        # Bound once: these are called for every task
+        append, extend = results.append, results.extend
+        record, record_many = self.execution_history.append, self.execution_history.extend
+        logger.info("Running tasks %s in process: %s...", "in parallel" if self.is_parallel else "sequentially", self.name)
+
+        async def execute_task(task):
+            # Failures are recorded rather than raised, so concurrent siblings keep running
+            try:
+                return task, await task.execute(), True
+            except Exception as error:
+                return task, self._record_failure(task, error), False
+
         if self.is_parallel:
-            tasks = [self.execute_task(task) for task in self.tasks]
-            results = await asyncio.gather(*tasks, return_exceptions=True)
-        else:
-            for task in self.tasks:
-                result = await self.execute_task(task)
-                if result is None and task.critical:
+            loop = asyncio.get_running_loop()
+            # Created through the loop so an eager task factory can finish quick tasks without scheduling them
+            scheduled = list(self.iter_tasks())
+            order = {loop.create_task(execute_task(task)): index for index, task in enumerate(scheduled)}
+            pending = set(order)
+            deadline = None if timeout is None else loop.time() + timeout
+            stop = False
+            # Handle tasks as they finish instead of waiting for the slowest one (results are in completion order)
+            while pending and not stop:
+                remaining = None if deadline is None else max(0, deadline - loop.time())
+                done, pending = await asyncio.wait(pending, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    logger.error("Timed out waiting for %d task(s) in process: %s", len(pending), self.name)
                     break
-                results.append(result)
+                for future in sorted(done, key=order.__getitem__):
+                    task, result, succeeded = future.result()
+                    if succeeded:
+                        record(task.description)
+                    if not succeeded and task.critical:
+                        stop = True
+                        continue
+                    append(result)
+            # Cancel whatever is still running after a timeout or a critical failure
+            for future in pending:
+                future.cancel()
+            if pending:
+                await asyncio.wait(pending)
+            # Record every cancelled task so callers can tell a cut-short run from a complete one
+            for future in sorted(pending, key=order.__getitem__):
+                self.failures.append(f"Failure in process {self.name}: Task cancelled: {scheduled[order[future]].description}")
+        else:
+            for task, repetitions, parallel_repeats in zip(self.tasks, self.repetitions, self.parallel_repeats):
+                # A deterministic task whose tools are all pure gives the same result every time, so one
+                # successful run stands in for all its repetitions (its tools are still charged for each)
+                if repetitions > 1 and task.deterministic and not task.tool_limits and all(tool.pure for tool in task.tools):
+                    task, result, succeeded = await execute_task(task)
+                    if succeeded:
+                        for tool in task.tools:
+                            tool.usage_count += repetitions - 1
+                        record_many([task.description] * repetitions)
+                        extend([result] * repetitions)
+                        continue
+                    if not succeeded and task.critical:
+                        return results
+                    # A failure might not happen again, so run the remaining repetitions for real
+                    append(result)
+                    repetitions -= 1
+                # Repeats flagged as independent run together, then the process carries on sequentially
+                batches, batch_size = (1, repetitions) if parallel_repeats else (repetitions, 1)
+                for _ in range(batches):
+                    if batch_size == 1:
+                        # Awaited inline: no wrapper coroutine per run
+                        try:
+                            outcomes = [(task, await task.execute(), True)]
+                        except Exception as error:
+                            outcomes = [(task, self._record_failure(task, error), False)]
+                    else:
+                        async with asyncio.TaskGroup() as group:
+                            repeats = [group.create_task(execute_task(task)) for _ in range(batch_size)]
+                        outcomes = [repeat.result() for repeat in repeats]
+                    for task, result, succeeded in outcomes:
+                        if succeeded:
+                            record(task.description)
+                        if not succeeded and task.critical:
+                            return results
+                        append(result)
         return results
 
-    async def execute_task(self, task, input=None):
-        try:
-            result = await task.execute(input)
-            self.execution_history.append(f"Task executed: {task.description}")
-            return result
-        except Exception as error:
-            print(f"{datetime.now()} - Error executing task: {task.description} in process: {self.name}", error)
-            self.failures.append(f"Failure in process {self.name}: {str(error)}")
-            if task.critical:
-                print(f"{datetime.now()} - Critical task failed. Exiting process: {self.name}")
-                return None
-            return error
+    def _record_failure(self, task, error):
+        """Record a failed task and return what stands in for its result (None for critical tasks)."""
+        if isinstance(error, _EXPECTED_FAILURES):
+            error = error.with_traceback(None)
+        logger.error("Error executing task: %s in process: %s %s", task.description, self.name, error)
+        self.failures.append(f"Failure in process {self.name}: {str(error)}")
+        if task.critical:
+            logger.error("Critical task failed. Exiting process: %s", self.name)
+            return None
+        return error
 
-    def add_task(self, task, repetitions=1):
-        self.tasks.extend([task]*repetitions)
+    def add_task(self, task, repetitions=1, parallel_repeats=False):
+        """Add a task to the process; with parallel_repeats its repetitions run concurrently even in a sequential process."""
+        self.tasks.append(task)
+        self.repetitions.append(repetitions)
+        self.parallel_repeats.append(parallel_repeats)
+
+    def iter_tasks(self):
+        """Yield every task to run, repeating each one as many times as it was added."""
+        return itertools.chain.from_iterable(itertools.repeat(task, repetitions) for task, repetitions in zip(self.tasks, self.repetitions))
 
     def clear_tasks(self):
         self.tasks.clear()
+        self.repetitions.clear()
+        self.parallel_repeats.clear()
         self.execution_history.clear()
         self.failures.clear()
 
     def get_execution_history(self):
-        return self.execution_history.copy()
+        return tuple(self.execution_history)
+
+    def format_history(self):
+        """Lazily format the execution history for display."""
+        return (f"Task executed: {description}" for description in self.execution_history)
 
     def get_failures(self):
         return self.failures.copy()
 
 class Agent:
+    __slots__ = ()
+
     def __init__(self):
         pass
 
@@ -98,8 +311,14 @@ class Agent:
         return results
 
 async def main():
-    tool1 = Tool("UPPER", "Converts text to uppercase", lambda text: text.upper())
-    task1 = Task("id_1", "hello", lambda _: asyncio.sleep(2, "hello (async)"), [tool1], critical=True)
+    # Task logs are written out once per process run instead of one write per line
+    log_handler = BufferedLogHandler(sys.stdout)
+    log_handler.setFormatter(logging.Formatter("%(asctime)s - %(message)s"))
+    logging.basicConfig(level=logging.INFO, handlers=[log_handler])
+    if hasattr(asyncio, "eager_task_factory"):  # Python 3.12+
+        asyncio.get_running_loop().set_task_factory(asyncio.eager_task_factory)
+    tool1 = Tool("UPPER", "Converts text to uppercase", lambda text: text.upper(), pure=True)
+    task1 = Task("id_1", "hello", lambda _: asyncio.sleep(2, "hello (async)"), [tool1], critical=True, deterministic=True)
     task1.set_tool_limit(tool1.name, 2)
 
     task2 = Task("id_2", "world", lambda _: asyncio.sleep(2, "world (async)"))
@@ -111,9 +330,10 @@ async def main():
     my_process = CustomProcess("Parallel Process", [task1, task2], True)
     agent = Agent()
     results = await agent.execute_process(my_process)
-    print("Results:", [result for result in results if not isinstance(result, Exception)])
-    print("Execution history:", " ".join(my_process.get_execution_history()))
-    print("Failures:", "\n".join(my_process.get_failures()))
+    log_handler.flush()
+    print("\n".join([f"Results: {[result for result in results if not isinstance(result, Exception)]}",
+                     "Execution history: " + " ".join(my_process.format_history()),
+                     "Failures: " + "\n".join(my_process.get_failures())]))
 
     print("\nRunning tasks sequentially:")
     my_process = CustomProcess("Sequential Process")
@@ -122,8 +342,11 @@ async def main():
     my_process.add_task(task3)
     my_process.is_parallel = False
     results2 = await agent.execute_process(my_process)
-    print("Results:", [result for result in results2 if not isinstance(result, Exception)])
-    print("Execution history:", " ".join(my_process.get_execution_history()))
-    print("Failures:", "\n".join(my_process.get_failures()))
+    log_handler.flush()
+    print("\n".join([f"Results: {[result for result in results2 if not isinstance(result, Exception)]}",
+                     "Execution history: " + " ".join(my_process.format_history()),
+                     "Failures: " + "\n".join(my_process.get_failures())]))
 
-asyncio.run(main())
+if __name__ == "__main__":
+    with asyncio.Runner() as runner:
+        runner.run(main())